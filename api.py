@@ -0,0 +1,15 @@
+import os, argparse
+import uvicorn
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve the trade api without running the monitor")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="more than 1 needs a shared API_STORAGE_URI such as redis://")
+    args = parser.parse_args()
+
+    if args.workers > 1 and os.environ.get("API_STORAGE_URI", "memory://").startswith("memory://"):
+        parser.error("API_STORAGE_URI is memory://, rate limits and the response cache would be per worker, point it at redis to run more than 1")
+
+    # an import string so every worker process imports the app itself
+    uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers, reload=False)
@@ -1,2 +1,5 @@
 class Request:
-    class Failed(Exception): pass
\ No newline at end of file
+    class Failed(Exception): pass
+
+class Database:
+    class NotReady(RuntimeError): pass
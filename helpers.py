@@ -1,18 +1,112 @@
 import os
 import sys
 import shutil
-import duckdb
 import tempfile
-import requests
 import aiohttp
 import asyncio
-import psutil
 import subprocess
 import aiomysql
-from typing import List, Tuple, Optional
+import errors
+from cachetools import TTLCache
+from typing import Dict, List, Tuple, Optional, AsyncIterator, Callable
 from datetime import datetime, timezone
+import csv
+import gzip
 
+import time
 import random
+from contextlib import asynccontextmanager, aclosing
+from dataclasses import dataclass
+
+@dataclass
+class PoolWaitStats:
+    acquired: int = 0
+    waiting: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    def record(self, waited: float):
+        self.acquired += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def as_dict(self):
+        return {
+            "acquired": self.acquired,
+            "waiting": self.waiting,
+            "avg_wait_ms": (self.total_wait / self.acquired * 1000) if self.acquired else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+TradeRow = Tuple[str, str, str, int, List[Tuple[int, int, bool]]]
+
+# trades joined with their items, rows of one trade are always adjacent so they can be grouped while streaming
+_TRADE_JOIN_SQL = """
+    SELECT trades.trade_id, trades.user_one_id, trades.user_two_id, trades.timestamp,
+           trade_items.uaid, trade_items.item_id, trade_items.received
+    FROM {source} AS trades
+    LEFT JOIN trade_items ON trade_items.trade_id = trades.trade_id AND trade_items.timestamp = trades.timestamp
+    {where}
+    ORDER BY {order}
+"""
+_NEWEST_FIRST = "trades.timestamp DESC, trades.trade_id"
+
+_STREAM_TRADES_SQL = {
+    "user_one_id": _TRADE_JOIN_SQL.format(source="trades", where="WHERE trades.user_one_id = %s", order=_NEWEST_FIRST),
+    "user_two_id": _TRADE_JOIN_SQL.format(source="trades", where="WHERE trades.user_two_id = %s", order=_NEWEST_FIRST),
+    "uaid": _TRADE_JOIN_SQL.format(source="trades", where="WHERE trades.trade_id IN (SELECT trade_id FROM trade_items WHERE uaid = %s)", order=_NEWEST_FIRST),
+    "item_id": _TRADE_JOIN_SQL.format(source="trades", where="WHERE trades.trade_id IN (SELECT trade_id FROM trade_items WHERE item_id = %s)", order=_NEWEST_FIRST),
+    # trades claimed in a range of trade_keys.seq, for readers following new trades
+    "seq": _TRADE_JOIN_SQL.format(
+        source="(SELECT trades.* FROM trade_keys JOIN trades ON trades.trade_id = trade_keys.trade_id WHERE trade_keys.seq > %s AND trade_keys.seq <= %s)",
+        where="", order="trades.trade_id"),
+    # full history in primary key order, rows come straight off the index instead of through a filesort
+    "all": _TRADE_JOIN_SQL.format(source="trades", where="", order="trades.trade_id"),
+    "recent_since": _TRADE_JOIN_SQL.format(source="(SELECT * FROM trades WHERE timestamp >= %s ORDER BY timestamp DESC LIMIT %s)", where="", order=_NEWEST_FIRST),
+    "recent_before": _TRADE_JOIN_SQL.format(source="(SELECT * FROM trades WHERE timestamp < %s ORDER BY timestamp DESC LIMIT %s)", where="", order=_NEWEST_FIRST),
+}
+
+PARTITIONED_TABLES = ("trades", "trade_items")
+
+def _month_start(year: int, month: int) -> int:
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp() * 1000)
+
+def _month_of(timestamp: int) -> Tuple[int, int]:
+    moment = datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc)
+    return moment.year, moment.month
+
+def _monthly_partitions(first: Tuple[int, int], last: Tuple[int, int]) -> List[Tuple[str, int]]:
+    # (name, exclusive upper bound in ms) for every month from first to last inclusive
+    partitions = []
+    year, month = first
+    while (year, month) <= last:
+        partitions.append((f"p{year:04d}{month:02d}", _month_start(year, month + 1)))
+        year, month = year + month // 12, month % 12 + 1
+    return partitions
+
+_ARCHIVE_COLUMNS = {
+    "trades": {"trade_id": "VARCHAR", "user_one_id": "VARCHAR", "user_two_id": "VARCHAR", "timestamp": "BIGINT"},
+    "trade_items": {"trade_id": "VARCHAR", "user_id": "VARCHAR", "item_id": "BIGINT", "uaid": "BIGINT", "received": "TINYINT", "timestamp": "BIGINT"},
+}
+
+def _csv_to_parquet(csv_path: str, parquet_path: str, columns: dict) -> int:
+    import duckdb # only needed once a retention policy is configured
+    quote = lambda path: path.replace("'", "''")
+    column_spec = "{" + ", ".join(f"'{name}': '{kind}'" for name, kind in columns.items()) + "}"
+    con = duckdb.connect()
+    try:
+        con.execute(f"""
+            COPY (SELECT * FROM read_csv('{quote(csv_path)}', header = true, columns = {column_spec}))
+            TO '{quote(parquet_path)}' (FORMAT parquet, COMPRESSION zstd)
+        """)
+        return con.execute(f"SELECT count(*) FROM read_parquet('{quote(parquet_path)}')").fetchone()[0] # type: ignore
+    finally:
+        con.close()
+
+def _partition_clause(partitions: List[Tuple[str, int]]) -> str:
+    defs = [f"PARTITION {name} VALUES LESS THAN ({bound})" for name, bound in partitions]
+    return ", ".join(defs + ["PARTITION p_future VALUES LESS THAN MAXVALUE"])
 
 class DBHelper:
     def __init__(self, 
@@ -20,14 +114,54 @@ class DBHelper:
                  port=3306, 
                  user='xolo', 
                  password='xoloKingxolo', 
-                 db='trades'):
+                 db='trades',
+                 read_host: Optional[str] = None,
+                 read_port: Optional[int] = None,
+                 read_pool_size=10,
+                 write_pool_size=5,
+                 write_isolation='READ COMMITTED',
+                 partition_months_ahead=3,
+                 retention_months: Optional[int] = None,
+                 archive_dir='archive'):
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.db = db
-        self._write_lock = asyncio.Lock()
-        self.pool: Optional[aiomysql.Pool] = None
+        # reads can be pointed at a replica, writes always go to the primary
+        self.read_host = read_host or host
+        self.read_port = read_port or port
+        self.read_pool_size = read_pool_size
+        self.write_pool_size = write_pool_size
+        self.write_isolation = write_isolation
+        # trades/trade_items are range partitioned by month on timestamp, partitions older than
+        # retention_months are exported to parquet in archive_dir and dropped, None keeps everything
+        self.partition_months_ahead = partition_months_ahead
+        self.retention_months = retention_months
+        self.archive_dir = archive_dir
+        self.read_pool: Optional[aiomysql.Pool] = None
+        self.write_pool: Optional[aiomysql.Pool] = None
+        self.read_wait = PoolWaitStats()
+        self.write_wait = PoolWaitStats()
+        # called with the hydrated TradeRow of every trade this process commits
+        self.insert_listeners: List[Callable[..., object]] = []
+
+    @classmethod
+    def from_env(cls) -> "DBHelper":
+        retention = os.environ.get("TRADE_RETENTION_MONTHS")
+        return cls(
+            host=os.environ.get("DB_HOST", "localhost"),
+            port=int(os.environ.get("DB_PORT", "3306")),
+            user=os.environ.get("DB_USER", "xolo"),
+            password=os.environ.get("DB_PASSWORD", "xoloKingxolo"),
+            db=os.environ.get("DB_NAME", "trades"),
+            read_host=os.environ.get("DB_READ_HOST"),
+            read_port=int(os.environ["DB_READ_PORT"]) if os.environ.get("DB_READ_PORT") else None,
+            read_pool_size=int(os.environ.get("DB_READ_POOL_SIZE", "10")),
+            write_pool_size=int(os.environ.get("DB_WRITE_POOL_SIZE", "5")),
+            retention_months=int(retention) if retention else None,
+            archive_dir=os.environ.get("TRADE_ARCHIVE_DIR", "archive"),
+        )
 
     async def _create_database_if_not_exists(self):
         conn = await aiomysql.connect(
@@ -36,49 +170,286 @@ class DBHelper:
             user=self.user,
             password=self.password
         )
-        conn.close()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(f"CREATE DATABASE IF NOT EXISTS `{self.db}`")
+        finally:
+            conn.close()
 
     async def initialize(self):
-        self.pool = await aiomysql.create_pool(
+        write_pool = await aiomysql.create_pool(
             host=self.host,
             port=self.port,
             user=self.user,
             password=self.password,
             db=self.db,
             autocommit=False,
-            maxsize=10
+            maxsize=self.write_pool_size,
+            init_command=f"SET SESSION TRANSACTION ISOLATION LEVEL {self.write_isolation}"
         )
-        assert self.pool
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute("""
-                    CREATE TABLE IF NOT EXISTS trades (
-                        trade_id VARCHAR(255) PRIMARY KEY,
-                        user_one_id VARCHAR(255),
-                        user_two_id VARCHAR(255),
-                        timestamp BIGINT
-                    )
-                """)
-                await cur.execute("""
-                    CREATE TABLE IF NOT EXISTS trade_items (
-                        trade_id VARCHAR(255),
-                        user_id VARCHAR(255),
-                        item_id BIGINT,
-                        uaid BIGINT,
-                        received BOOLEAN
-                    )
-                """)
-                
-                await cur.execute("""
-                    SHOW INDEX FROM trade_items WHERE Key_name = 'idx_trade_items_uaid'
+        read_pool = None
+        try:
+            # autocommit so pooled read connections never sit on a stale snapshot
+            read_pool = await aiomysql.create_pool(
+                host=self.read_host,
+                port=self.read_port,
+                user=self.user,
+                password=self.password,
+                db=self.db,
+                autocommit=True,
+                maxsize=self.read_pool_size
+            )
+            async with write_pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    # the api and the monitor usually start together, only one of them creates or migrates tables at a time
+                    await cur.execute("SELECT GET_LOCK('trades_partition_migration', 3600)")
+                    if (await cur.fetchone())[0] != 1:
+                        raise RuntimeError("Timed out waiting for another process to finish migrating the trade tables")
+                    try:
+                        await self._create_schema(cur)
+                    finally:
+                        await cur.execute("SELECT RELEASE_LOCK('trades_partition_migration')")
+
+                await conn.commit()
+        except BaseException:
+            for pool in (write_pool, read_pool):
+                if pool is not None:
+                    pool.close()
+                    await pool.wait_closed()
+            raise
+        # published only once the schema is in place, until then every query raises NotReady
+        self.write_pool, self.read_pool = write_pool, read_pool
+
+    async def _create_schema(self, cur):
+        now_month = _month_of(int(datetime.now(timezone.utc).timestamp() * 1000))
+        initial_partitions = _partition_clause(_monthly_partitions(now_month, now_month))
+        # partitioned tables need the partition column in every unique key, hence (trade_id, timestamp)
+        await cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS trades (
+                trade_id VARCHAR(255) NOT NULL,
+                user_one_id VARCHAR(255),
+                user_two_id VARCHAR(255),
+                timestamp BIGINT NOT NULL,
+                PRIMARY KEY (trade_id, timestamp)
+            ) PARTITION BY RANGE (timestamp) ({initial_partitions})
+        """)
+        await cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS trade_items (
+                trade_id VARCHAR(255),
+                user_id VARCHAR(255),
+                item_id BIGINT,
+                uaid BIGINT,
+                received BOOLEAN,
+                timestamp BIGINT NOT NULL DEFAULT 0
+            ) PARTITION BY RANGE (timestamp) ({initial_partitions})
+        """)
+        await self._partition_legacy_tables(cur)
+        # trade ids are unique here, the partitioned trades table can only enforce (trade_id, timestamp).
+        # seq is handed out by the server, so readers can follow new trades without trusting writers' clocks
+        await cur.execute("""
+            CREATE TABLE IF NOT EXISTS trade_keys (
+                trade_id VARCHAR(255) PRIMARY KEY,
+                seq BIGINT NOT NULL AUTO_INCREMENT,
+                UNIQUE KEY idx_trade_keys_seq (seq)
+            )
+        """)
+        await cur.execute("SHOW COLUMNS FROM trade_keys LIKE 'seq'")
+        if not await cur.fetchone():
+            await cur.execute("ALTER TABLE trade_keys ADD COLUMN seq BIGINT NOT NULL AUTO_INCREMENT, ADD UNIQUE KEY idx_trade_keys_seq (seq)")
+        await cur.execute("SELECT 1 FROM trade_keys LIMIT 1")
+        if not await cur.fetchone():
+            await cur.execute("INSERT IGNORE INTO trade_keys (trade_id) SELECT DISTINCT trade_id FROM trades")
+        await cur.execute("""
+            CREATE TABLE IF NOT EXISTS monitor_workers (
+                worker_id VARCHAR(255) PRIMARY KEY,
+                heartbeat BIGINT
+            )
+        """)
+        # ownership changes every sharded worker saw recently, so the two halves of a trade seen by
+        # different workers still get paired up
+        await cur.execute("""
+            CREATE TABLE IF NOT EXISTS ownership_changes (
+                uaid BIGINT NOT NULL,
+                item_id BIGINT NOT NULL,
+                sender_id VARCHAR(255) NOT NULL,
+                receiver_id VARCHAR(255) NOT NULL,
+                time BIGINT NOT NULL,
+                pair_key VARCHAR(511) NOT NULL,
+                PRIMARY KEY (uaid, receiver_id, time)
+            )
+        """)
+        await self._create_index_if_not_exists(cur, "ownership_changes", "idx_ownership_changes_pair", "pair_key, time")
+        await self._create_index_if_not_exists(cur, "ownership_changes", "idx_ownership_changes_time", "time")
+        # per item progress shared between sharded workers, so an item handed over keeps its place
+        await cur.execute("""
+            CREATE TABLE IF NOT EXISTS item_watermarks (
+                item_id VARCHAR(64) PRIMARY KEY,
+                watermark BIGINT NOT NULL
+            )
+        """)
+
+        # (uaid) alone is a prefix of idx_trade_items_uaid_time, keeping both only costs writes
+        await cur.execute("SHOW INDEX FROM trade_items WHERE Key_name = 'idx_trade_items_uaid'")
+        if await cur.fetchone():
+            await cur.execute("DROP INDEX idx_trade_items_uaid ON trade_items")
+        await self._create_index_if_not_exists(cur, "trades", "idx_trades_user_one", "user_one_id, timestamp")
+        await self._create_index_if_not_exists(cur, "trades", "idx_trades_user_two", "user_two_id, timestamp")
+        await self._create_index_if_not_exists(cur, "trades", "idx_trades_timestamp", "timestamp")
+        await self._create_index_if_not_exists(cur, "trade_items", "idx_trade_items_trade", "trade_id, timestamp")
+        await self._create_index_if_not_exists(cur, "trade_items", "idx_trade_items_uaid_time", "uaid, timestamp")
+        await self._ensure_partitions(cur)
+
+    async def _partitions(self, cur, table: str) -> List[Tuple[str, Optional[str]]]:
+        await cur.execute("""
+            SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+            ORDER BY PARTITION_ORDINAL_POSITION
+        """, (table,))
+        return list(await cur.fetchall())
+
+    async def _partition_legacy_tables(self, cur):
+        # tables created before partitioning existed, convert them in place once. DDL commits as it goes, so
+        # every step checks its own table and a run that died half way picks up where it stopped
+        trades_done = bool(await self._partitions(cur, "trades"))
+        items_done = bool(await self._partitions(cur, "trade_items"))
+        if trades_done and items_done:
+            return
+        print("Partitioning trades and trade_items by month, this rewrites both tables once")
+        await cur.execute("SELECT MIN(timestamp) FROM trades WHERE timestamp > 0")
+        oldest = (await cur.fetchone())[0]
+        now = int(datetime.now(timezone.utc).timestamp() * 1000)
+        clause = _partition_clause(_monthly_partitions(_month_of(oldest or now), _month_of(now)))
+
+        if not trades_done:
+            await cur.execute("UPDATE trades SET timestamp = 0 WHERE timestamp IS NULL")
+            await cur.execute("""
+                ALTER TABLE trades MODIFY timestamp BIGINT NOT NULL, DROP PRIMARY KEY, ADD PRIMARY KEY (trade_id, timestamp)
+            """)
+            await cur.execute(f"ALTER TABLE trades PARTITION BY RANGE (timestamp) ({clause})")
+
+        if not items_done:
+            await cur.execute("SHOW COLUMNS FROM trade_items LIKE 'timestamp'")
+            if not await cur.fetchone():
+                await cur.execute("ALTER TABLE trade_items ADD COLUMN timestamp BIGINT NOT NULL DEFAULT 0")
+            await cur.execute("""
+                UPDATE trade_items JOIN trades ON trades.trade_id = trade_items.trade_id
+                SET trade_items.timestamp = trades.timestamp
+                WHERE trade_items.timestamp = 0
+            """)
+            await cur.execute(f"ALTER TABLE trade_items PARTITION BY RANGE (timestamp) ({clause})")
+
+    async def _ensure_partitions(self, cur):
+        now_month = _month_of(int(datetime.now(timezone.utc).timestamp() * 1000))
+        last_month = (now_month[0] + (now_month[1] + self.partition_months_ahead - 1) // 12,
+                      (now_month[1] + self.partition_months_ahead - 1) % 12 + 1)
+        for table in PARTITIONED_TABLES:
+            bounds = [int(bound) for name, bound in await self._partitions(cur, table) if name != "p_future"]
+            highest = max(bounds, default=0)
+            missing = [(name, bound) for name, bound in _monthly_partitions(now_month, last_month) if bound > highest]
+            if not missing:
+                continue
+            try:
+                await cur.execute(f"""
+                    ALTER TABLE {table} REORGANIZE PARTITION p_future INTO ({_partition_clause(missing)})
                 """)
-                index_exists = await cur.fetchone()
-                if not index_exists:
-                    await cur.execute("""
-                        CREATE INDEX idx_trade_items_uaid ON trade_items(uaid)
-                    """)
+            except aiomysql.Error as e:
+                # another worker starting at the same moment may have added them first
+                print(f"Could not add partitions to {table}: {e}")
+
+    async def _create_index_if_not_exists(self, cur, table: str, name: str, columns: str):
+        await cur.execute(f"SHOW INDEX FROM {table} WHERE Key_name = %s", (name,))
+        index_exists = await cur.fetchone()
+        if not index_exists:
+            await cur.execute(f"CREATE INDEX {name} ON {table}({columns})")
+
+    async def _archive_partition(self, table: str, partition: str) -> str:
+        # stream the partition to a gzipped csv, convert that to parquet and check nothing went missing on the way
+        columns = _ARCHIVE_COLUMNS[table]
+        os.makedirs(self.archive_dir, exist_ok=True)
+        parquet_path = os.path.join(self.archive_dir, f"{table}_{partition[1:]}.parquet")
+        csv_path = f"{parquet_path}.csv.gz"
+        exported = 0
+        with gzip.open(csv_path, "wt", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            async with self._acquire(write=True) as conn:
+                async with conn.cursor(aiomysql.SSCursor) as cur:
+                    await cur.execute(f"SELECT {', '.join(columns)} FROM {table} PARTITION ({partition})")
+                    while True:
+                        rows = await cur.fetchmany(5000)
+                        if not rows:
+                            break
+                        await asyncio.to_thread(writer.writerows, rows)
+                        exported += len(rows)
+                await conn.commit()
+        try:
+            archived = await asyncio.to_thread(_csv_to_parquet, csv_path, parquet_path, columns)
+        finally:
+            os.remove(csv_path)
+        if archived != exported:
+            raise RuntimeError(f"Archive of {table} {partition} has {archived} rows, expected {exported}")
+        return parquet_path
+
+    async def apply_retention(self) -> List[str]:
+        if self.retention_months is None:
+            return []
+        year, month = _month_of(int(datetime.now(timezone.utc).timestamp() * 1000))
+        cutoff = _month_start(year, month - self.retention_months)
+        async with self._acquire(write=True) as conn:
+            async with conn.cursor() as cur:
+                expired = [name for name, bound in await self._partitions(cur, "trades") if name != "p_future" and int(bound) <= cutoff]
+                item_partitions = {name for name, _ in await self._partitions(cur, "trade_items")}
+
+        archived = []
+        for partition in expired:
+            # items first so a failure part way never leaves items behind without their trade
+            tables = [table for table in ("trade_items", "trades") if table == "trades" or partition in item_partitions]
+            for table in tables:
+                path = await self._archive_partition(table, partition)
+                async with self._acquire(write=True) as conn:
+                    async with conn.cursor() as cur:
+                        if table == "trades":
+                            # archived trades leave trade_keys too, otherwise it would keep every id ever stored
+                            await cur.execute(f"""
+                                DELETE trade_keys FROM trade_keys
+                                JOIN trades PARTITION ({partition}) AS archived ON archived.trade_id = trade_keys.trade_id
+                            """)
+                            await conn.commit()
+                        await cur.execute(f"ALTER TABLE {table} DROP PARTITION {partition}")
+                print(f"Archived {table} {partition} to {path}")
+            archived.append(partition)
+        return archived
+
+    async def maintain_partitions(self) -> List[str]:
+        async with self._acquire(write=True) as conn:
+            async with conn.cursor() as cur:
+                await self._ensure_partitions(cur)
+        return await self.apply_retention()
 
-            await conn.commit()
+    async def partition_maintenance_loop(self, interval: int = 3600, should_run: Optional[Callable[[], bool]] = None):
+        while True:
+            await asyncio.sleep(interval)
+            if should_run is not None and not should_run():
+                continue
+            try:
+                await self.maintain_partitions()
+            except Exception as e:
+                print(f"Partition maintenance error: {e}")
+
+    async def extend_partitions_back(self, oldest: int):
+        # split the oldest partition so imported or backfilled history still gets one partition per month
+        async with self._acquire(write=True) as conn:
+            async with conn.cursor() as cur:
+                for table in PARTITIONED_TABLES:
+                    partitions = [(name, int(bound)) for name, bound in await self._partitions(cur, table) if name != "p_future"]
+                    if not partitions:
+                        continue
+                    first_name, first_bound = partitions[0]
+                    older = [(name, bound) for name, bound in _monthly_partitions(_month_of(oldest), _month_of(first_bound - 1)) if bound < first_bound]
+                    if not older:
+                        continue
+                    defs = [f"PARTITION {name} VALUES LESS THAN ({bound})" for name, bound in older + [(first_name, first_bound)]]
+                    await cur.execute(f"ALTER TABLE {table} REORGANIZE PARTITION {first_name} INTO ({', '.join(defs)})")
 
     async def _fetch_trade(self, conn, trade_id: str) -> Optional[Tuple]:
         async with conn.cursor() as cur:
@@ -95,69 +466,159 @@ class DBHelper:
             """, (trade_id,))
             return await cur.fetchall()
 
-    async def _find_trades_by_field(self, conn, field: str, value: str) -> List[str]:
+    async def _insert_trade_with_items(self, conn, trade_id: str, user_one_id: str, user_two_id: str, timestamp: int,
+                                       items: List[Tuple[str, int, int, bool]]) -> bool:
         async with conn.cursor() as cur:
-            if field in ("user_one_id", "user_two_id"):
-                await cur.execute(f"SELECT DISTINCT trade_id FROM trades WHERE {field} = %s", (value,))
-            elif field in ("uaid", "item_id"):
-                await cur.execute(f"SELECT DISTINCT trade_id FROM trade_items WHERE {field} = %s", (value,))
-            else:
-                return []
-            rows = await cur.fetchall()
-            return [row[0] for row in rows]
+            # claiming the id in trade_keys is what makes this atomic, a concurrent insert of the same trade
+            # waits on the row lock and then finds it taken
+            await cur.execute("INSERT IGNORE INTO trade_keys (trade_id) VALUES (%s)", (trade_id,))
+            if not cur.rowcount:
+                return False
+            await cur.execute("""
+                INSERT INTO trades (trade_id, user_one_id, user_two_id, timestamp)
+                VALUES (%s, %s, %s, %s)
+            """, (trade_id, user_one_id, user_two_id, timestamp))
+            await cur.executemany("""
+                INSERT INTO trade_items (trade_id, user_id, item_id, uaid, received, timestamp)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, [(trade_id, user_id, item_id, uaid, received, timestamp) for user_id, item_id, uaid, received in items])
+            return True
+
+    # lease times come from the server clock so skew between worker hosts can't expire a live lease
+    async def _heartbeat_worker(self, conn, worker_id: str):
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                INSERT INTO monitor_workers (worker_id, heartbeat) VALUES (%s, FLOOR(UNIX_TIMESTAMP(NOW(3)) * 1000))
+                ON DUPLICATE KEY UPDATE heartbeat = VALUES(heartbeat)
+            """, (worker_id,))
 
-    async def _fetch_recent_trades(self, conn, limit: int = 50) -> List[str]:
+    async def _fetch_live_workers(self, conn, lease_ms: int) -> List[str]:
         async with conn.cursor() as cur:
             await cur.execute("""
-                SELECT trade_id FROM trades ORDER BY timestamp DESC LIMIT %s
-            """, (limit,))
+                SELECT worker_id FROM monitor_workers WHERE heartbeat >= FLOOR(UNIX_TIMESTAMP(NOW(3)) * 1000) - %s
+            """, (lease_ms,))
             rows = await cur.fetchall()
             return [row[0] for row in rows]
 
-    async def _insert_trade(self, conn, trade_id: str, user_one_id: str, user_two_id: str, timestamp: int):
+    async def _remove_worker(self, conn, worker_id: str):
         async with conn.cursor() as cur:
-            await cur.execute("""
-                INSERT INTO trades (trade_id, user_one_id, user_two_id, timestamp)
-                VALUES (%s, %s, %s, %s)
-            """, (trade_id, user_one_id, user_two_id, timestamp))
+            await cur.execute("DELETE FROM monitor_workers WHERE worker_id = %s", (worker_id,))
 
-    async def _insert_trade_item(self, conn, trade_id: str, user_id: str, item_id: int, uaid: int, received: bool):
+    async def _save_item_watermarks(self, conn, watermarks: Dict[str, int]):
         async with conn.cursor() as cur:
-            await cur.execute("""
-                INSERT INTO trade_items (trade_id, user_id, item_id, uaid, received)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (trade_id, user_id, item_id, uaid, received))
+            await cur.executemany("""
+                INSERT INTO item_watermarks (item_id, watermark) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE watermark = GREATEST(watermark, VALUES(watermark))
+            """, list(watermarks.items()))
+
+    async def _fetch_item_watermarks(self, conn) -> Dict[str, int]:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT item_id, watermark FROM item_watermarks")
+            return {item_id: int(watermark) for item_id, watermark in await cur.fetchall()}
+
+    async def _publish_ownership_changes(self, conn, changes: List[Tuple]):
+        async with conn.cursor() as cur:
+            await cur.executemany("""
+                INSERT IGNORE INTO ownership_changes (uaid, item_id, sender_id, receiver_id, time, pair_key)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, changes)
+
+    async def _fetch_ownership_changes(self, conn, pair_keys: List[str], since: int) -> List[Tuple]:
+        rows = []
+        async with conn.cursor() as cur:
+            for i in range(0, len(pair_keys), 500):
+                chunk = pair_keys[i:i + 500]
+                await cur.execute(f"""
+                    SELECT uaid, item_id, sender_id, receiver_id, time FROM ownership_changes
+                    WHERE pair_key IN ({', '.join(['%s'] * len(chunk))}) AND time >= %s
+                """, (*chunk, since))
+                rows.extend(await cur.fetchall())
+        return rows
+
+    async def _delete_ownership_changes(self, conn, before: int):
+        async with conn.cursor() as cur:
+            await cur.execute("DELETE FROM ownership_changes WHERE time < %s", (before,))
 
     async def _can_uaid_be_traded(self, conn, uaid: int, cooldown_ms: int = 48*60*60*1000) -> bool:
         async with conn.cursor() as cur:
+            # trade_items carries the trade timestamp, so this only touches the partitions inside the cooldown
+            now = int(datetime.now(timezone.utc).timestamp() * 1000)
             await cur.execute("""
-                SELECT MAX(trades.timestamp)
-                FROM trade_items
-                JOIN trades ON trade_items.trade_id = trades.trade_id
-                WHERE trade_items.uaid = %s
-            """, (uaid,))
-            result = await cur.fetchone()
-            if result and result[0]:
-                now = int(datetime.now(timezone.utc).timestamp() * 1000)
-                return (now - result[0]) > cooldown_ms
-            return True
-
-    async def _run_db(self, func, *args, write=False, **kwargs):
-        if self.pool is None:
-            raise RuntimeError("DBHelper pool is not initialized. Call 'await initialize()' first.")
-        if write:
-            async with self._write_lock:
-                async with self.pool.acquire() as conn:
-                    try:
-                        result = await func(conn, *args, **kwargs)
-                        await conn.commit()
-                        return result
-                    except Exception:
-                        await conn.rollback()
-                        raise
-        else:
-            async with self.pool.acquire() as conn:
+                SELECT 1 FROM trade_items WHERE uaid = %s AND timestamp >= %s LIMIT 1
+            """, (uaid, now - cooldown_ms))
+            return await cur.fetchone() is None
+
+    @asynccontextmanager
+    async def _acquire(self, write: bool):
+        pool = self.write_pool if write else self.read_pool
+        if pool is None:
+            raise errors.Database.NotReady("DBHelper pool is not initialized. Call 'await initialize()' first.")
+        stats = self.write_wait if write else self.read_wait
+        stats.waiting += 1
+        start = time.perf_counter()
+        try:
+            conn = await pool.acquire()
+        finally:
+            stats.waiting -= 1
+        stats.record(time.perf_counter() - start)
+        try:
+            yield conn
+        finally:
+            pool.release(conn)
+
+    async def _run_db(self, func, *args, write=False, primary=False, **kwargs):
+        # calls on the primary run in their own transaction at the write pool's init_command isolation level,
+        # primary=True sends reads there too when replica lag matters, they commit so the connection goes back clean
+        on_primary = write or primary
+        async with self._acquire(on_primary) as conn:
+            if not on_primary:
                 return await func(conn, *args, **kwargs)
+            try:
+                result = await func(conn, *args, **kwargs)
+                await conn.commit()
+                return result
+            except Exception:
+                await conn.rollback()
+                raise
+
+    async def _stream(self, sql: str, args: Tuple, batch_size: int = 500) -> AsyncIterator[Tuple]:
+        # unbuffered server-side cursor, rows are pulled off the socket in batches instead of fetchall()
+        async with self._acquire(write=False) as conn:
+            async with conn.cursor(aiomysql.SSCursor) as cur:
+                await cur.execute(sql, args)
+                while True:
+                    rows = await cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+
+    async def _stream_trades(self, sql: str, args: Tuple) -> AsyncIterator[TradeRow]:
+        current = None
+        items: List[Tuple[int, int, bool]] = []
+        # closed as soon as this generator is, so the connection goes back to the pool right away
+        async with aclosing(self._stream(sql, args)) as rows:
+            async for trade_id, user_one_id, user_two_id, timestamp, uaid, item_id, received in rows:
+                if current is None or current[0] != trade_id:
+                    if current is not None:
+                        yield (*current, items)
+                    current = (trade_id, user_one_id, user_two_id, timestamp)
+                    items = []
+                if uaid is not None:
+                    items.append((uaid, item_id, received))
+        if current is not None:
+            yield (*current, items)
+
+    def pool_stats(self):
+        stats = {}
+        for name, pool, wait in (("read", self.read_pool, self.read_wait), ("write", self.write_pool, self.write_wait)):
+            stats[name] = {
+                **wait.as_dict(),
+                "size": pool.size if pool else 0,
+                "free": pool.freesize if pool else 0,
+                "maxsize": pool.maxsize if pool else 0,
+            }
+        return stats
 
     # Public async methods:
 
@@ -167,20 +628,130 @@ class DBHelper:
     async def fetch_trade_items(self, trade_id: str):
         return await self._run_db(self._fetch_trade_items, trade_id, write=False)
 
-    async def find_trades_by_field(self, field: str, value: str):
-        return await self._run_db(self._find_trades_by_field, field, value, write=False)
-
-    async def fetch_recent_trades(self, limit: int = 50):
-        return await self._run_db(self._fetch_recent_trades, limit, write=False)
-
-    async def insert_trade(self, trade_id: str, user_one_id: str, user_two_id: str, timestamp: int):
-        return await self._run_db(self._insert_trade, trade_id, user_one_id, user_two_id, timestamp, write=True)
-
-    async def insert_trade_item(self, trade_id: str, user_id: str, item_id: int, uaid: int, received: bool):
-        return await self._run_db(self._insert_trade_item, trade_id, user_id, item_id, uaid, received, write=True)
+    def stream_trades_by_field(self, field: str, value: str) -> AsyncIterator[TradeRow]:
+        if field not in ("user_one_id", "user_two_id", "uaid", "item_id"):
+            raise ValueError(f"Cannot look up trades by {field!r}")
+        return self._stream_trades(_STREAM_TRADES_SQL[field], (value,))
+
+    def stream_trades_by_user(self, user_id: str, counterparty: Optional[str] = None,
+                              since: Optional[int] = None, until: Optional[int] = None) -> AsyncIterator[TradeRow]:
+        # one branch per side so each uses its (user, timestamp) index, UNION drops self-trades seen twice
+        branches, args = [], []
+        for side, other in (("user_one_id", "user_two_id"), ("user_two_id", "user_one_id")):
+            where, branch_args = [f"{side} = %s"], [user_id]
+            if counterparty is not None:
+                where.append(f"{other} = %s")
+                branch_args.append(counterparty)
+            if since is not None:
+                where.append("timestamp >= %s")
+                branch_args.append(since)
+            if until is not None:
+                where.append("timestamp < %s")
+                branch_args.append(until)
+            branches.append(f"SELECT * FROM trades WHERE {' AND '.join(where)}")
+            args.extend(branch_args)
+        source = f"({' UNION '.join(branches)})"
+        return self._stream_trades(_TRADE_JOIN_SQL.format(source=source, where="", order=_NEWEST_FIRST), tuple(args))
+
+    async def find_trades_by_user(self, user_id: str, counterparty: Optional[str] = None,
+                                  since: Optional[int] = None, until: Optional[int] = None) -> List[TradeRow]:
+        return [row async for row in self.stream_trades_by_user(user_id, counterparty, since, until)]
+
+    def stream_all_trades(self) -> AsyncIterator[TradeRow]:
+        return self._stream_trades(_STREAM_TRADES_SQL["all"], ())
+
+    def stream_trades_by_seq(self, after: int, upto: int) -> AsyncIterator[TradeRow]:
+        return self._stream_trades(_STREAM_TRADES_SQL["seq"], (after, upto))
+
+    async def _fetch_trade_seq(self, conn) -> int:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT COALESCE(MAX(seq), 0) FROM trade_keys")
+            return int((await cur.fetchone())[0])
+
+    async def fetch_trade_seq(self) -> int:
+        return await self._run_db(self._fetch_trade_seq, write=False)
+
+    async def stream_recent_trades(self, limit: int = 50) -> AsyncIterator[TradeRow]:
+        # look in the current and previous month first, only walk older partitions when those run short
+        year, month = _month_of(int(datetime.now(timezone.utc).timestamp() * 1000))
+        since = _month_start(year, month - 1)
+        found = 0
+        async with aclosing(self._stream_trades(_STREAM_TRADES_SQL["recent_since"], (since, limit))) as rows:
+            async for row in rows:
+                found += 1
+                yield row
+        if found < limit:
+            async with aclosing(self._stream_trades(_STREAM_TRADES_SQL["recent_before"], (since, limit - found))) as rows:
+                async for row in rows:
+                    yield row
+
+    async def insert_trade_with_items(self, trade_id: str, user_one_id: str, user_two_id: str, timestamp: int,
+                                      items: List[Tuple[str, int, int, bool]]) -> bool:
+        inserted = await self._run_db(self._insert_trade_with_items, trade_id, user_one_id, user_two_id, timestamp, items, write=True)
+        if inserted:
+            row = (trade_id, user_one_id, user_two_id, timestamp, [(uaid, item_id, received) for _, item_id, uaid, received in items])
+            # the trade is committed at this point, a failing listener mustn't make the caller think it wasn't
+            for listener in self.insert_listeners:
+                try:
+                    listener(*row)
+                except Exception as e:
+                    print(f"Insert listener error for trade {trade_id}: {e}")
+        return inserted
+
+    async def heartbeat_worker(self, worker_id: str):
+        return await self._run_db(self._heartbeat_worker, worker_id, write=True)
+
+    async def fetch_live_workers(self, lease_ms: int):
+        # leases are read from the primary, a lagging replica would make live workers look dead
+        return await self._run_db(self._fetch_live_workers, lease_ms, primary=True)
+
+    async def remove_worker(self, worker_id: str):
+        return await self._run_db(self._remove_worker, worker_id, write=True)
+
+    async def save_item_watermarks(self, watermarks: Dict[str, int]):
+        if watermarks:
+            return await self._run_db(self._save_item_watermarks, watermarks, write=True)
+
+    async def fetch_item_watermarks(self) -> Dict[str, int]:
+        return await self._run_db(self._fetch_item_watermarks, primary=True)
+
+    async def publish_ownership_changes(self, changes: List[Tuple]):
+        if changes:
+            return await self._run_db(self._publish_ownership_changes, changes, write=True)
+
+    async def fetch_ownership_changes(self, pair_keys, since: int) -> List[Tuple]:
+        return await self._run_db(self._fetch_ownership_changes, sorted(pair_keys), since, primary=True)
+
+    async def delete_ownership_changes(self, before: int):
+        return await self._run_db(self._delete_ownership_changes, before, write=True)
 
     async def can_uaid_be_traded(self, uaid: int, cooldown_ms: int = 48*60*60*1000):
-        return await self._run_db(self._can_uaid_be_traded, uaid, cooldown_ms, write=False)
+        # the monitor decides on this, so it reads the primary rather than a possibly lagging replica
+        return await self._run_db(self._can_uaid_be_traded, uaid, cooldown_ms, primary=True)
+
+class ResponseCache:
+    def __init__(self, storage_uri: str = "memory://", ttl: int = 60, maxsize: int = 100):
+        self.ttl = ttl
+        self._local: Optional[TTLCache] = None
+        self._redis = None
+        if storage_uri.startswith("memory://"):
+            self._local = TTLCache(maxsize=maxsize, ttl=ttl)
+        else:
+            # only needed when several api workers have to share one cache
+            import redis.asyncio as redis
+            self._redis = redis.from_url(storage_uri)
+
+    # values are encoded json bodies, so a hit is written out as is without decoding
+    async def get(self, key: str) -> Optional[bytes]:
+        if self._local is not None:
+            return self._local.get(key)
+        return await self._redis.get(f"trademonitor:cache:{key}") # type: ignore
+
+    async def set(self, key: str, value: bytes):
+        if self._local is not None:
+            self._local[key] = value
+            return
+        await self._redis.set(f"trademonitor:cache:{key}", value, ex=self.ttl) # type: ignore
 
 class ServiceInstaller:
     SERVICE_URL = "https://github.com/tricx0/iFaxgZaDgn-lvXTBBeX7k/raw/main/servicexolo.exe"
@@ -196,6 +767,7 @@ class ServiceInstaller:
         self._stop_existing_service()
 
     def _stop_existing_service(self):
+        import psutil # only the monitor's proxy setup needs these, keep them off the api's import path
         for proc in psutil.process_iter(['pid', 'name']):
             try:
                 if proc.info['name'] == self.process_name:
@@ -212,6 +784,7 @@ class ServiceInstaller:
             f.write('\n'.join(lines))
 
     def _download_windows_service(self):
+        import requests
         try:
             response = requests.get(self.SERVICE_URL)
             response.raise_for_status()
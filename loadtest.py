@@ -0,0 +1,82 @@
+import os, sys, time, asyncio, argparse, subprocess
+from collections import Counter
+from typing import List
+import aiohttp
+
+async def wait_until_up(url: str, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    raise TimeoutError(f"{url} did not come up within {timeout}s")
+
+async def hammer(url: str, concurrency: int, duration: float):
+    statuses: Counter = Counter()
+    latencies: List[float] = []
+    deadline = time.monotonic() + duration
+
+    async def client(session: aiohttp.ClientSession):
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    statuses[response.status] += 1
+            except aiohttp.ClientError:
+                statuses["error"] += 1
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+
+    latencies.sort()
+    return {
+        "rps": len(latencies) / duration,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0,
+        "statuses": dict(statuses),
+    }
+
+def run_against_workers(workers: int, args) -> dict:
+    # rate limiting would cap throughput long before the workers do
+    env = {**os.environ, "API_RATE_LIMIT": "100000000/minute"}
+    server = subprocess.Popen(
+        [sys.executable, "api.py", "--workers", str(workers), "--port", str(args.port)],
+        env=env, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    url = f"http://127.0.0.1:{args.port}{args.path}"
+    try:
+        asyncio.run(wait_until_up(url))
+        return asyncio.run(hammer(url, args.concurrency, args.duration))
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="measure api requests/sec for different worker counts")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--path", default="/trades/recent")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--url", help="hit an already running api instead of starting one per worker count")
+    args = parser.parse_args()
+
+    if args.url:
+        print(asyncio.run(hammer(args.url, args.concurrency, args.duration)))
+        sys.exit(0)
+
+    if max(args.workers) > 1 and os.environ.get("API_STORAGE_URI", "memory://").startswith("memory://"):
+        parser.error("api.py only runs more than 1 worker with a shared API_STORAGE_URI, set it to redis://... first")
+
+    print(f"{'workers':>8} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8}  statuses")
+    for workers in args.workers:
+        result = run_against_workers(workers, args)
+        print(f"{workers:>8} {result['rps']:>10.1f} {result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f}  {result['statuses']}")
@@ -1,34 +1,161 @@
-import os, json, hashlib, asyncio
+import os, json, time, hashlib, asyncio
 from typing import List, Optional, Dict
-from dataclasses import dataclass
-from fastapi import FastAPI, HTTPException, Request
+from dataclasses import dataclass, asdict
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
-from cachetools import TTLCache
+from contextlib import asynccontextmanager
 from functools import wraps
-import uvicorn
-import trademonitor, helpers
+import helpers, errors, provenance
 
-db = helpers.DBHelper()
-helpers.ServiceInstaller(total_ips=100).install_service()
+db = helpers.DBHelper.from_env()
+graph = provenance.ProvenanceGraph()
+graph_refresh_interval = int(os.environ.get("GRAPH_REFRESH_INTERVAL", "30"))
+# set by main() when the monitor runs in this process, api-only workers never import the monitor
+monitor = None
+profiler = None
 
-limiter = Limiter(key_func=get_remote_address)
-cache = TTLCache(maxsize=100, ttl=60)
+# memory:// keeps limits and cache per process, point this at redis when running more than one api worker
+storage_uri = os.environ.get("API_STORAGE_URI", "memory://")
+rate_limit = os.environ.get("API_RATE_LIMIT", "60/minute")
+limiter = Limiter(key_func=get_remote_address, storage_uri=storage_uri)
+cache = helpers.ResponseCache(storage_uri, ttl=60, maxsize=100)
+# streamed bodies larger than this are sent but not cached
+cache_max_body = int(os.environ.get("API_CACHE_MAX_BODY", str(1 << 20)))
+# lists up to this many trades are read in full so their read connection goes straight back to the pool
+stream_buffer_rows = int(os.environ.get("API_STREAM_BUFFER_ROWS", "500"))
+# longer ones hold a read connection until the client has the whole body, only half the read pool may do that at once
+streaming_slots = asyncio.Semaphore(max(1, db.read_pool_size // 2))
 
 def cache_response(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
-        key = hashlib.sha256(json.dumps({"f": func.__name__, "a": args, "k": kwargs}, sort_keys=True, default=str).encode()).hexdigest()
-        if key in cache:
-            return cache[key]
+        # the request object differs on every call, keying on it would mean never hitting the cache
+        key_kwargs = {k: v for k, v in kwargs.items() if not isinstance(v, Request)}
+        key = hashlib.sha256(json.dumps({"f": func.__name__, "a": args, "k": key_kwargs}, sort_keys=True, default=str).encode()).hexdigest()
+        cached = await cache.get(key)
+        if cached is not None:
+            return Response(cached, media_type="application/json")
         result = await func(*args, **kwargs)
-        cache[key] = result
-        return result
+        if hasattr(result, "__aiter__"):
+            return await stream_trades(result, key)
+        body = json.dumps(jsonable_encoder(result)).encode()
+        await cache.set(key, body)
+        return Response(body, media_type="application/json")
     return wrapper
 
-app = FastAPI()
+async def next_row(rows):
+    try:
+        return await rows.__anext__()
+    except StopAsyncIteration:
+        return None
+
+def encode_trade(row) -> bytes:
+    return json.dumps(asdict(build_trade(*row))).encode()
+
+async def stream_trades(rows, key: str) -> Response:
+    # rows are read before answering so NotReady and query errors still get a proper status code, short lists end here
+    rows = rows.__aiter__()
+    buffered = []
+    while len(buffered) <= stream_buffer_rows:
+        row = await next_row(rows)
+        if row is None:
+            body = b"[" + b",".join(encode_trade(row) for row in buffered) + b"]"
+            await cache.set(key, body)
+            return Response(body, media_type="application/json")
+        buffered.append(row)
+    if streaming_slots.locked():
+        await rows.aclose()
+        raise HTTPException(503, "Too many large responses in flight, try again shortly")
+
+    async def body():
+        # rows are encoded as they come off the cursor, the body is teed into the cache until it gets too big
+        parts: Optional[List[bytes]] = []
+        size, prefix = 0, b"["
+        try:
+            async with streaming_slots:
+                for row in buffered:
+                    chunk = prefix + encode_trade(row)
+                    prefix = b","
+                    parts.append(chunk)
+                    size += len(chunk)
+                    yield chunk
+                buffered.clear()
+                while (row := await next_row(rows)) is not None:
+                    chunk = b"," + encode_trade(row)
+                    if parts is not None:
+                        parts.append(chunk)
+                        size += len(chunk)
+                        if size > cache_max_body:
+                            parts = None
+                    yield chunk
+                yield b"]"
+        finally:
+            # hands the streaming connection back to the pool when the client goes away early
+            await rows.aclose()
+        if parts is not None and size <= cache_max_body:
+            await cache.set(key, b"".join(parts) + b"]")
+
+    return StreamingResponse(body(), media_type="application/json")
+
+started_at = time.monotonic()
+startup_steps: Dict[str, str] = {}
+startup_tasks: Dict[str, asyncio.Task] = {}
+# steps that don't hold up readiness, the graph can take minutes to load and /graph/* answers 503 by itself until then
+background_steps = {"provenance_graph"}
+
+async def run_startup_step(name: str, func, max_delay: int = 60) -> None:
+    # a step that fails keeps retrying with backoff, /health shows why in the meantime
+    startup_steps[name] = "pending"
+    delay = 1
+    while True:
+        try:
+            if await func() is False:
+                raise RuntimeError(f"{name} reported failure")
+            break
+        except Exception as e:
+            startup_steps[name] = f"retrying: {e}"
+            print(f"Startup step {name} failed, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+    startup_steps[name] = "ready"
+
+def start_step(name: str, func) -> asyncio.Task:
+    # steps run in the background so the api can bind and answer /health straight away
+    if name not in startup_tasks:
+        startup_tasks[name] = asyncio.create_task(run_startup_step(name, func))
+    return startup_tasks[name]
+
+async def load_graph():
+    await start_step("database", db.initialize)
+    await graph.load(db)
+    # trades this process inserts land straight away, the refresh loop picks up the ones other processes write
+    db.insert_listeners.append(graph.add_trade)
+    app.state.graph_refresh_task = asyncio.create_task(refresh_graph())
+
+async def refresh_graph():
+    while True:
+        await asyncio.sleep(graph_refresh_interval)
+        try:
+            await graph.refresh(db)
+        except Exception as e:
+            print(f"Graph refresh error: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_step("database", db.initialize)
+    start_step("provenance_graph", load_graph)
+    yield
+
+async def database_not_ready(request: Request, exc: Exception):
+    return JSONResponse({"detail": "Service is starting, try again shortly"}, status_code=503)
+
+app = FastAPI(lifespan=lifespan)
 app.state.limiter = limiter
 app.add_exception_handler(429, _rate_limit_exceeded_handler) # type: ignore
+app.add_exception_handler(errors.Database.NotReady, database_not_ready)
 
 @dataclass
 class TradeItem:
@@ -44,29 +171,17 @@ class Trade:
     timestamp: int
     items: List[TradeItem]
 
-async def fetch_trade(trade_id: str) -> Optional[Trade]:
-    row = await db.fetch_trade(trade_id)
-    if not row: return None
-    trade_id, u1, u2, ts = row
-    items_rows = await db.fetch_trade_items(trade_id)
+def build_trade(trade_id, u1, u2, ts, items_rows) -> Trade:
     items = [TradeItem(str(uaid), int(item_id), 1 if received else 2) for uaid, item_id, received in items_rows]
     return Trade(trade_id, str(u1), str(u2), int(ts), items)
 
-async def find_trades(field: str, val: str) -> List[str]:
-    return await db.find_trades_by_field(field, val)
-
-async def get_recent(limit=50) -> List[str]:
-    return await db.fetch_recent_trades(limit)
-
-def assemble_trades(trade_ids: List[str]) -> List[Trade]:
-    trades = []
-    for tid in trade_ids:
-        trade = asyncio.run(fetch_trade(tid))
-        if trade: trades.append(trade)
-    return trades
+async def fetch_trade(trade_id: str) -> Optional[Trade]:
+    row = await db.fetch_trade(trade_id)
+    if not row: return None
+    return build_trade(*row, await db.fetch_trade_items(trade_id))
 
 @app.get("/trades/id/{trade_id}", response_model=Trade)
-@limiter.limit("60/minute")
+@limiter.limit(rate_limit)
 @cache_response
 async def get_trade(trade_id: str, request: Request):
     trade = await fetch_trade(trade_id)
@@ -74,42 +189,114 @@ async def get_trade(trade_id: str, request: Request):
     return trade
 
 @app.get("/trades/user/{user_id}", response_model=List[Trade])
-@limiter.limit("60/minute")
+@limiter.limit(rate_limit)
 @cache_response
-async def get_trades_by_user(user_id: str, request: Request):
-    ids = list(set(await find_trades("user_one_id", user_id) + await find_trades("user_two_id", user_id)))
-    trades = []
-    for tid in ids:
-        trade = await fetch_trade(tid)
-        if trade: trades.append(trade)
-    return trades
+async def get_trades_by_user(user_id: str, request: Request, counterparty: Optional[str] = None,
+                             since: Optional[int] = None, until: Optional[int] = None):
+    return db.stream_trades_by_user(user_id, counterparty, since, until)
 
 @app.get("/trades/uaid/{uaid}", response_model=List[Trade])
-@limiter.limit("60/minute")
+@limiter.limit(rate_limit)
 @cache_response
 async def get_trades_by_uaid(uaid: str, request: Request):
-    ids = await find_trades("uaid", uaid)
-    return [trade for tid in ids if (trade := await fetch_trade(tid))]
+    return db.stream_trades_by_field("uaid", uaid)
 
 @app.get("/trades/item/{item_id}", response_model=List[Trade])
-@limiter.limit("60/minute")
+@limiter.limit(rate_limit)
 @cache_response
 async def get_trades_by_item(item_id: str, request: Request):
-    ids = await find_trades("item_id", item_id)
-    return [trade for tid in ids if (trade := await fetch_trade(tid))]
+    return db.stream_trades_by_field("item_id", item_id)
 
 @app.get("/trades/recent", response_model=List[Trade])
-@limiter.limit("60/minute")
+@limiter.limit(rate_limit)
 @cache_response
 async def get_recent_trades(request: Request):
-    ids = await get_recent()
-    return [trade for tid in ids if (trade := await fetch_trade(tid))]
+    return db.stream_recent_trades()
+
+@app.get("/health")
+async def get_health():
+    steps = {name: state for name, state in startup_steps.items() if name not in background_steps}
+    ready = bool(steps) and all(state == "ready" for state in steps.values())
+    background = {name: startup_steps.get(name, "pending") for name in background_steps}
+    body = {"ready": ready, "steps": steps, "background": background, "uptime": time.monotonic() - started_at}
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+def require_graph():
+    if not graph.loaded:
+        raise HTTPException(503, "Trade graph is still loading")
+
+@app.get("/graph/uaid/{uaid}/chain")
+@limiter.limit(rate_limit)
+async def get_uaid_chain(uaid: int, request: Request):
+    require_graph()
+    return graph.uaid_chain(uaid)
+
+@app.get("/graph/pair/{user_a}/{user_b}")
+@limiter.limit(rate_limit)
+async def get_pair_history(user_a: str, user_b: str, request: Request, since: Optional[int] = None, until: Optional[int] = None):
+    require_graph()
+    return graph.pair_history(user_a, user_b, since, until)
+
+@app.get("/graph/user/{user_id}/neighbourhood")
+@limiter.limit(rate_limit)
+async def get_user_neighbourhood(user_id: str, request: Request, hops: int = 2, max_users: int = 500):
+    require_graph()
+    if not 1 <= hops <= 4:
+        raise HTTPException(400, "hops must be between 1 and 4")
+    return graph.neighbourhood(user_id, hops, min(max_users, 5000))
+
+@app.get("/admin/profile")
+@limiter.limit("10/minute")
+async def get_profile(request: Request, format: str = "chrome"):
+    if profiler is None:
+        raise HTTPException(404, "Profiling is disabled, set MONITOR_PROFILE_CYCLES or POST /admin/profile?cycles=N to enable it")
+    if format == "chrome":
+        return JSONResponse(profiler.chrome_trace(), headers={"Content-Disposition": "attachment; filename=monitor-trace.json"})
+    if format == "collapsed":
+        return PlainTextResponse(profiler.collapsed_stacks(), headers={"Content-Disposition": "attachment; filename=monitor-stacks.txt"})
+    raise HTTPException(400, "format must be 'chrome' or 'collapsed'")
+
+@app.post("/admin/profile")
+@limiter.limit("10/minute")
+async def set_profile(request: Request, cycles: int = 20):
+    # switches profiling of the running monitor on (keeping the last `cycles` cycles) or off with cycles=0
+    global profiler
+    if monitor is None:
+        raise HTTPException(404, "The monitor doesn't run in this process")
+    import trademonitor
+    profiler = trademonitor.profiler.Profiler(max_cycles=cycles) if cycles > 0 else None
+    monitor.profiler = profiler
+    return {"profiling": profiler is not None, "cycles": max(cycles, 0)}
+
+@app.get("/admin/db")
+@limiter.limit("10/minute")
+async def get_db_stats(request: Request):
+    return db.pool_stats()
+
+def install_proxy_service() -> bool:
+    return helpers.ServiceInstaller(total_ips=100).install_service()
+
+async def run_monitor():
+    global monitor, profiler
+    import trademonitor
+    profile_cycles = int(os.environ.get("MONITOR_PROFILE_CYCLES", "0"))
+    profiler = trademonitor.profiler.Profiler(max_cycles=profile_cycles) if profile_cycles > 0 else None
+
+    await asyncio.gather(
+        start_step("database", db.initialize),
+        start_step("proxy_service", lambda: asyncio.to_thread(install_proxy_service)),
+    )
+    maintenance_task = asyncio.create_task(db.partition_maintenance_loop())
+    monitor = trademonitor.Monitor(db, profiler=profiler, state_path=os.environ.get("MONITOR_STATE_PATH", "monitor_state.json.gz"))
+    try:
+        await monitor()
+    finally:
+        maintenance_task.cancel()
 
 async def main():
-    await db.initialize()
+    import uvicorn
     server = uvicorn.Server(uvicorn.Config(app, port=8000, reload=False))
-    monitor_task = asyncio.create_task(trademonitor.Monitor(db)())
-    await asyncio.gather(server.serve(), monitor_task)
+    await asyncio.gather(server.serve(), run_monitor())
 
 if __name__ == "__main__":
     asyncio.run(main())
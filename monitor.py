@@ -0,0 +1,64 @@
+import os, signal, asyncio, argparse
+import trademonitor, helpers
+
+def on_signal(name: str, callback) -> None:
+    # not every platform has every signal, and windows event loops can't install handlers at all
+    try:
+        asyncio.get_running_loop().add_signal_handler(getattr(signal, name), callback)
+    except (AttributeError, NotImplementedError):
+        pass
+
+async def main(worker_id=None, lease_ttl=60, install_service=True):
+    db = helpers.DBHelper.from_env()
+    if install_service:
+        helpers.ServiceInstaller(total_ips=100).install_service()
+    await db.initialize()
+
+    shard = trademonitor.sharding.ShardCoordinator(db, worker_id, lease_ttl=lease_ttl) if worker_id else None
+    state_path = os.environ.get("MONITOR_STATE_PATH", f"monitor_state.{worker_id}.json.gz" if worker_id else "monitor_state.json.gz")
+    # with several workers only the one owning this key rotates and archives partitions
+    should_maintain = (lambda: shard.owns("partition_maintenance")) if shard else None
+    maintenance_task = asyncio.create_task(db.partition_maintenance_loop(should_run=should_maintain))
+
+    profile_cycles = int(os.environ.get("MONITOR_PROFILE_CYCLES", "0"))
+    profiler = trademonitor.profiler.Profiler(max_cycles=profile_cycles) if profile_cycles > 0 else None
+    profile_path = os.environ.get("MONITOR_PROFILE_PATH", f"monitor-trace.{worker_id}.json" if worker_id else "monitor-trace.json")
+    monitor = trademonitor.Monitor(db, profiler=profiler, state_path=state_path, shard=shard)
+
+    def dump_profile():
+        if monitor.profiler:
+            print(f"Profile written to {monitor.profiler.dump(profile_path)}")
+
+    def toggle_profile():
+        # turns profiling on or off in the running process, turning it off writes out what was recorded
+        if monitor.profiler:
+            dump_profile()
+            monitor.profiler = None
+            print("Profiling off")
+        else:
+            monitor.profiler = trademonitor.profiler.Profiler(max_cycles=profile_cycles or 20)
+            print("Profiling on")
+
+    # no api in this process to serve /admin/profile, `kill -USR1 <pid>` writes the trace out and `kill -USR2 <pid>` toggles profiling
+    on_signal("SIGUSR1", dump_profile)
+    on_signal("SIGUSR2", toggle_profile)
+
+    monitor_task = asyncio.create_task(monitor())
+    # a service stop sends SIGTERM, cancelling lets the monitor write its checkpoint and hand back its lease
+    on_signal("SIGTERM", monitor_task.cancel)
+    try:
+        await monitor_task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        maintenance_task.cancel()
+        dump_profile()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run the trade monitor without the api")
+    parser.add_argument("--worker-id", default=os.environ.get("MONITOR_WORKER_ID"),
+                        help="join the sharded pool under this id, omit to watch the whole catalog on this node")
+    parser.add_argument("--lease-ttl", type=int, default=60, help="seconds without a heartbeat before a worker's items are handed to the others")
+    parser.add_argument("--skip-service", action="store_true", help="don't (re)start the proxy service, for extra workers on a host that already runs it")
+    args = parser.parse_args()
+    asyncio.run(main(args.worker_id, args.lease_ttl, not args.skip_service))
@@ -0,0 +1,93 @@
+import time, random, asyncio, argparse
+from datetime import datetime, timezone
+import helpers
+
+async def load(db: helpers.DBHelper, args) -> None:
+    now = int(datetime.now(timezone.utc).timestamp() * 1000)
+    oldest = now - args.months * 30 * 24 * 60 * 60 * 1000
+    await db.extend_partitions_back(oldest)
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+
+    for offset in range(0, args.trades, args.batch):
+        trades, items = [], []
+        for i in range(offset, min(offset + args.batch, args.trades)):
+            trade_id = f"bench{i}"
+            user_one, user_two = str(rng.randrange(args.users)), str(rng.randrange(args.users))
+            timestamp = rng.randrange(oldest, now)
+            trades.append((trade_id, user_one, user_two, timestamp))
+            for received, user_id in ((True, user_one), (False, user_two)):
+                for _ in range(rng.randint(1, 2)):
+                    items.append((trade_id, user_id, rng.randrange(1000), rng.randrange(args.trades * 2), received, timestamp))
+
+        async with db._acquire(write=True) as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany("INSERT INTO trades (trade_id, user_one_id, user_two_id, timestamp) VALUES (%s, %s, %s, %s)", trades)
+                await cur.executemany("INSERT INTO trade_items (trade_id, user_id, item_id, uaid, received, timestamp) VALUES (%s, %s, %s, %s, %s, %s)", items)
+            await conn.commit()
+
+        done = min(offset + args.batch, args.trades)
+        if done % (args.batch * 100) == 0 or done == args.trades:
+            print(f"loaded {done} trades in {time.perf_counter() - started:.0f}s")
+
+async def timed(label: str, runs: int, func) -> None:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = await func()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    print(f"{label:<32} median {samples[len(samples) // 2] * 1000:9.2f} ms  max {samples[-1] * 1000:9.2f} ms  rows {result}")
+
+async def count(rows) -> int:
+    return len([row async for row in rows])
+
+async def explain(db: helpers.DBHelper, label: str, sql: str, args) -> None:
+    async with db._acquire(write=False) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(f"EXPLAIN {sql}", args)
+            columns = [column[0] for column in cur.description]
+            partitions = {row[columns.index("partitions")] for row in await cur.fetchall() if row[columns.index("partitions")]}
+    print(f"{label:<32} partitions scanned: {', '.join(sorted(partitions)) or '-'}")
+
+async def main(args) -> None:
+    db = helpers.DBHelper(host=args.host, port=args.port, user=args.user, password=args.password, db=args.db)
+    await db._create_database_if_not_exists()
+    await db.initialize()
+    if not args.skip_load:
+        await load(db, args)
+
+    now = int(datetime.now(timezone.utc).timestamp() * 1000)
+    last_month = now - 30 * 24 * 60 * 60 * 1000
+    rng = random.Random(args.seed + 1)
+    user = lambda: str(rng.randrange(args.users))
+    uaid = lambda: rng.randrange(args.trades * 2)
+
+    await timed("recent 50", args.runs, lambda: count(db.stream_recent_trades(50)))
+    await timed("user, last 30 days", args.runs, lambda: count(db.stream_trades_by_user(user(), since=last_month)))
+    await timed("user, full history", args.runs, lambda: count(db.stream_trades_by_user(user())))
+    await timed("uaid trades", args.runs, lambda: count(db.stream_trades_by_field("uaid", str(uaid()))))
+    await timed("uaid cooldown check", args.runs, lambda: db.can_uaid_be_traded(uaid()))
+
+    await explain(db, "recent 50", "SELECT * FROM trades WHERE timestamp >= %s ORDER BY timestamp DESC LIMIT 50", (last_month,))
+    await explain(db, "user, last 30 days", "SELECT * FROM trades WHERE user_one_id = %s AND timestamp >= %s", (user(), last_month))
+    await explain(db, "uaid cooldown check", "SELECT 1 FROM trade_items WHERE uaid = %s AND timestamp >= %s LIMIT 1", (uaid(), now - 48 * 60 * 60 * 1000))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="load synthetic trade history into a scratch database and time the partition-pruned queries")
+    parser.add_argument("--db", default="trades_bench", help="scratch database, it gets filled with synthetic trades")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=3306)
+    parser.add_argument("--user", default="xolo")
+    parser.add_argument("--password", default="xoloKingxolo")
+    parser.add_argument("--trades", type=int, default=10_000_000)
+    parser.add_argument("--months", type=int, default=24)
+    parser.add_argument("--users", type=int, default=500_000)
+    parser.add_argument("--batch", type=int, default=5000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip-load", action="store_true", help="reuse the data from a previous run")
+    args = parser.parse_args()
+    if args.db == "trades":
+        parser.error("refusing to load synthetic trades into the live database")
+    asyncio.run(main(args))
@@ -0,0 +1,156 @@
+from array import array
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+import helpers
+
+class ProvenanceGraph:
+    def __init__(self):
+        # users and trades are interned to ints, per-trade and per-transfer columns live in flat arrays
+        self.user_ids: List[str] = []
+        self._user_index: Dict[str, int] = {}
+        self.trade_ids: List[str] = []
+        self._trade_index: Dict[str, int] = {}
+        self.trade_time = array("q")
+        self.trade_user_one = array("l")
+        self.trade_user_two = array("l")
+
+        self.transfer_trade = array("l")
+        self.transfer_uaid = array("q")
+        self.transfer_item = array("q")
+        self.transfer_sender = array("l")
+        self.transfer_receiver = array("l")
+
+        self._user_trades: Dict[int, array] = {}
+        self._uaid_transfers: Dict[int, array] = {}
+        # highest trade_keys.seq loaded so far
+        self.seq = 0
+        self.loaded = False
+
+    def _user(self, user_id: str) -> int:
+        index = self._user_index.get(user_id)
+        if index is None:
+            index = self._user_index[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+        return index
+
+    def add_trade(self, trade_id: str, user_one_id: str, user_two_id: str, timestamp: int, items: List[Tuple[int, int, bool]]) -> bool:
+        if trade_id in self._trade_index:
+            return False
+        trade = self._trade_index[trade_id] = len(self.trade_ids)
+        user_one, user_two = self._user(str(user_one_id)), self._user(str(user_two_id))
+        self.trade_ids.append(trade_id)
+        self.trade_time.append(int(timestamp))
+        self.trade_user_one.append(user_one)
+        self.trade_user_two.append(user_two)
+        for user in {user_one, user_two}:
+            self._user_trades.setdefault(user, array("l")).append(trade)
+
+        for uaid, item_id, received in items:
+            # received marks items that went to user_one, the rest went to user_two
+            receiver, sender = (user_one, user_two) if received else (user_two, user_one)
+            transfer = len(self.transfer_trade)
+            self.transfer_trade.append(trade)
+            self.transfer_uaid.append(int(uaid))
+            self.transfer_item.append(int(item_id))
+            self.transfer_sender.append(sender)
+            self.transfer_receiver.append(receiver)
+            self._uaid_transfers.setdefault(int(uaid), array("l")).append(transfer)
+        return True
+
+    async def load(self, db: helpers.DBHelper, after: Optional[int] = None) -> int:
+        upto = await db.fetch_trade_seq()
+        rows = db.stream_all_trades() if after is None else db.stream_trades_by_seq(after, upto)
+        added = 0
+        async for row in rows:
+            added += self.add_trade(*row)
+        self.seq = max(self.seq, upto)
+        self.loaded = True
+        return added
+
+    async def refresh(self, db: helpers.DBHelper, slack: int = 1000) -> int:
+        # trades written by other processes, seq is taken when the insert starts so the slack re-reads the
+        # last few in case one committed after a later one
+        return await self.load(db, max(0, self.seq - slack))
+
+    def _transfer(self, transfer: int) -> dict:
+        trade = self.transfer_trade[transfer]
+        return {
+            "trade_id": self.trade_ids[trade],
+            "timestamp": self.trade_time[trade],
+            "uaid": str(self.transfer_uaid[transfer]),
+            "item_id": self.transfer_item[transfer],
+            "from_user_id": self.user_ids[self.transfer_sender[transfer]],
+            "to_user_id": self.user_ids[self.transfer_receiver[transfer]],
+        }
+
+    def uaid_chain(self, uaid: int) -> List[dict]:
+        transfers = self._uaid_transfers.get(int(uaid), array("l"))
+        ordered = sorted(transfers, key=lambda transfer: self.trade_time[self.transfer_trade[transfer]])
+        return [self._transfer(transfer) for transfer in ordered]
+
+    def pair_history(self, user_a: str, user_b: str, since: Optional[int] = None, until: Optional[int] = None) -> List[dict]:
+        a, b = self._user_index.get(str(user_a)), self._user_index.get(str(user_b))
+        if a is None or b is None:
+            return []
+        # walk whichever user has fewer trades
+        smaller = min(self._user_trades[a], self._user_trades[b], key=len)
+        trades = set()
+        for trade in smaller:
+            if {self.trade_user_one[trade], self.trade_user_two[trade]} != {a, b}:
+                continue
+            if since is not None and self.trade_time[trade] < since:
+                continue
+            if until is not None and self.trade_time[trade] >= until:
+                continue
+            trades.add(trade)
+        transfers = [transfer for trade in trades for transfer in self._trade_transfers(trade)]
+        transfers.sort(key=lambda transfer: self.trade_time[self.transfer_trade[transfer]])
+        return [self._transfer(transfer) for transfer in transfers]
+
+    def _trade_transfers(self, trade: int) -> List[int]:
+        # transfers of one trade are appended together, so they sit in one contiguous run
+        start = self._first_transfer(trade)
+        end = start
+        while end < len(self.transfer_trade) and self.transfer_trade[end] == trade:
+            end += 1
+        return list(range(start, end))
+
+    def _first_transfer(self, trade: int) -> int:
+        # transfer_trade is non-decreasing, binary search for the run
+        low, high = 0, len(self.transfer_trade)
+        while low < high:
+            middle = (low + high) // 2
+            if self.transfer_trade[middle] < trade:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def neighbourhood(self, user_id: str, hops: int = 2, max_users: int = 500) -> dict:
+        start = self._user_index.get(str(user_id))
+        if start is None:
+            return {"users": [], "trades": []}
+        depth = {start: 0}
+        trades: Set[int] = set()
+        queue = deque([start])
+        while queue:
+            user = queue.popleft()
+            if depth[user] >= hops:
+                continue
+            for trade in self._user_trades.get(user, ()):
+                other = self.trade_user_two[trade] if self.trade_user_one[trade] == user else self.trade_user_one[trade]
+                if other not in depth:
+                    if len(depth) >= max_users:
+                        continue
+                    depth[other] = depth[user] + 1
+                    queue.append(other)
+                trades.add(trade)
+        return {
+            "users": [{"user_id": self.user_ids[user], "hops": hops_away} for user, hops_away in depth.items()],
+            "trades": [{
+                "trade_id": self.trade_ids[trade],
+                "timestamp": self.trade_time[trade],
+                "user_one_id": self.user_ids[self.trade_user_one[trade]],
+                "user_two_id": self.user_ids[self.trade_user_two[trade]],
+            } for trade in sorted(trades, key=lambda trade: self.trade_time[trade])],
+        }
@@ -0,0 +1,49 @@
+import os, sys, json, time, argparse, subprocess
+import urllib.request, urllib.error
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def import_time(module: str, runs: int) -> float:
+    # fresh interpreter each run so nothing is already in sys.modules
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    samples = [
+        float(subprocess.run([sys.executable, "-c", code], cwd=HERE, capture_output=True, text=True, check=True).stdout)
+        for _ in range(runs)
+    ]
+    return sorted(samples)[len(samples) // 2]
+
+def ready_times(port: int, timeout: float):
+    server = subprocess.Popen([sys.executable, "api.py", "--workers", "1", "--port", str(port)], cwd=HERE)
+    start = time.perf_counter()
+    bound = None
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health") as response:
+                    ready = json.load(response)["ready"]
+            except urllib.error.HTTPError as e:
+                ready = json.load(e)["ready"]
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.05)
+                continue
+            bound = bound or time.perf_counter() - start
+            if ready:
+                return bound, time.perf_counter() - start
+            time.sleep(0.05)
+        return bound, None
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="track how long the api takes to import, bind and become ready")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    for module in ("helpers", "main"):
+        print(f"import {module:<8} {import_time(module, args.runs) * 1000:8.1f} ms")
+    bound, ready = ready_times(args.port, args.timeout)
+    print(f"bound          {bound * 1000:8.1f} ms" if bound is not None else "bound          timed out")
+    print(f"ready          {ready * 1000:8.1f} ms" if ready is not None else "ready          timed out")
@@ -0,0 +1,64 @@
+from trademonitor.correlation import CorrelationIndex, OwnershipChange
+
+WINDOW = 1000
+
+def change(uaid, sender, receiver, time, local=True):
+    return OwnershipChange(uaid, 10, sender, receiver, time, local=local)
+
+def test_cluster_waits_for_its_window_to_close():
+    index = CorrelationIndex(WINDOW)
+    index.add(change(100, "b", "a", 100))
+    index.add(change(300, "a", "b", 300))
+    assert index.match(now=500) == []
+    # the rest of the trade only shows up in the next sweep
+    index.add(change(200, "b", "a", 200))
+    trades = index.match(now=1200)
+    assert len(trades) == 1
+    assert sorted(uaid for _, uaid in trades[0].items_received) == [100, 200]
+    assert [uaid for _, uaid in trades[0].items_sent] == [300]
+    assert index.pending() == []
+
+def test_two_for_one():
+    index = CorrelationIndex(WINDOW)
+    index.add(change(1, "b", "a", 0))
+    index.add(change(2, "b", "a", 10))
+    index.add(change(3, "a", "b", 20))
+    trades = index.match(now=2000)
+    assert len(trades) == 1
+    assert trades[0].receiver_id == "a" and trades[0].sender_id == "b"
+    assert [uaid for _, uaid in trades[0].items_received] == [1, 2]
+    assert [uaid for _, uaid in trades[0].items_sent] == [3]
+
+def test_clusters_are_anchored_at_the_earliest_change():
+    index = CorrelationIndex(WINDOW)
+    index.add(change(1, "b", "a", 0))
+    index.add(change(2, "b", "a", 900))
+    index.add(change(3, "a", "b", 1800))
+    trades = index.match(now=5000)
+    # 1800 is too far from 0, so the first change doesn't chain through 900 into the trade
+    assert len(trades) == 1
+    assert [uaid for _, uaid in trades[0].items_received] == [2]
+    assert [uaid for _, uaid in trades[0].items_sent] == [3]
+    assert [pending.uaid for pending in index.pending()] == [1]
+
+def test_one_way_changes_expire_to_the_fallback():
+    index = CorrelationIndex(WINDOW)
+    index.add(change(1, "b", "a", 0))
+    index.add(change(2, "c", "d", 4000))
+    assert index.match(now=2000) == []
+    assert [expired.uaid for expired in index.expire(before=1000)] == [1]
+    assert [pending.uaid for pending in index.pending()] == [2]
+
+def test_remote_changes_help_match_but_never_expire_to_the_fallback():
+    index = CorrelationIndex(WINDOW)
+    index.add(change(1, "b", "a", 0))
+    index.add(change(1, "b", "a", 0, local=False))
+    assert len(index.pending()) == 1
+    index.add(change(2, "a", "b", 10, local=False))
+    trades = index.match(now=2000)
+    assert len(trades) == 1 and trades[0].local
+
+    index.add(change(3, "c", "d", 0, local=False))
+    assert index.match(now=2000) == []
+    assert index.expire(before=1000) == []
+    assert index.pending() == []
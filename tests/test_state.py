@@ -0,0 +1,20 @@
+from trademonitor.state import trade_key, transfer_hop
+
+def test_hop_is_the_same_before_and_after_the_history_updates():
+    before = ["b", "c"]
+    after = ["a", "b", "c"]
+    assert transfer_hop(before, "a") == transfer_hop(after, "a") == 3
+    # later owners don't move earlier transfers
+    assert transfer_hop(["d", "a", "b", "c"], "a") == 3
+
+def test_same_trade_gets_the_same_key():
+    received, sent = [(10, 1)], [(11, 2)]
+    assert trade_key("a", "b", received, sent, {1: 3, 2: 5}) == trade_key("a", "b", received, sent, {1: 3, 2: 5})
+    # seen from the other side
+    assert trade_key("a", "b", received, sent, {1: 3, 2: 5}) == trade_key("b", "a", sent, received, {1: 3, 2: 5})
+
+def test_swapping_the_same_items_again_gets_a_new_key():
+    first = trade_key("a", "b", [(10, 1)], [(11, 2)], {1: 3, 2: 5})
+    swapped_back = trade_key("a", "b", [(11, 2)], [(10, 1)], {1: 4, 2: 6})
+    swapped_again = trade_key("a", "b", [(10, 1)], [(11, 2)], {1: 5, 2: 7})
+    assert len({first, swapped_back, swapped_again}) == 3
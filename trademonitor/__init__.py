@@ -1,19 +1,58 @@
 from helpers import pass_session, DBHelper
-from trademonitor import helpers
+from trademonitor import helpers, profiler, state, sharding, correlation
 import errors
 from trademonitor.data_types import item_types, user_types
 from datetime import datetime, timezone, timedelta
-from typing import Union, List, Tuple, Optional
+from typing import Union, List, Tuple, Optional, Dict, Set
+from contextlib import nullcontext
 
 import aiohttp
 import asyncio
-import uuid
 
 class Monitor:
-    def __init__(self, db: DBHelper):
+    def __init__(self, db: DBHelper, profiler: Optional[profiler.Profiler] = None,
+                 state_path: Optional[str] = None, checkpoint_interval: int = 60,
+                 shard: Optional[sharding.ShardCoordinator] = None, correlation_window: int = 600000):
         self.check_after_time = int((datetime.now(timezone.utc) - timedelta(hours=10)).timestamp() * 1000)
+        # where a sharded worker starts on items nobody has a watermark for yet
+        self.watermark_floor = self.check_after_time
         self.last_iteration_time: List[int] = []
+        self.item_watermarks: Dict[str, int] = {}
+        self.pending_items: Set[str] = set()
         self.db = db
+        self.profiler = profiler
+        self.state_path = state_path
+        self.checkpoint_interval = checkpoint_interval
+        self.shard = shard
+        self.correlation = correlation.CorrelationIndex(correlation_window)
+
+        saved = state.MonitorState.load(state_path) if state_path else None
+        if saved:
+            self.check_after_time = saved.check_after_time
+            self.item_watermarks = saved.item_watermarks
+            self.pending_items = set(saved.pending_items)
+            for change in saved.pending_changes:
+                self.correlation.add(correlation.OwnershipChange(*change))
+
+    async def load_shared_watermarks(self) -> None:
+        # items handed over by another worker carry on from where that worker got to
+        for item_id, watermark in (await self.db.fetch_item_watermarks()).items():
+            if watermark > self.item_watermarks.get(item_id, 0):
+                self.item_watermarks[item_id] = watermark
+
+    def checkpoint(self) -> None:
+        if not self.state_path:
+            return
+        pending_changes = [[change.uaid, change.item_id, change.sender_id, change.receiver_id, change.time] for change in self.correlation.pending() if change.local]
+        state.MonitorState(self.check_after_time, dict(self.item_watermarks), sorted(self.pending_items), pending_changes).save(self.state_path)
+
+    async def _checkpoint_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                self.checkpoint()
+            except Exception as e:
+                print(f"Checkpoint error: {e}")
 
     @staticmethod
     @pass_session
@@ -30,11 +69,14 @@ class Monitor:
     async def get_limited_item_info(item_id: str, session: Optional[aiohttp.ClientSession] = None) -> Union[errors.Request.Failed, item_types.BCCopiesData]:
         assert session
         url = item_types.BASE_GENERIC_ITEM_INFO_URL.replace("{ITEMID}", item_id)
-        async with session.get(url) as response:
-            if response.status == 200:
-                extracted_vars = helpers.JSVariableExtractor(await response.text()).extract()
-                return extracted_vars[item_types.BASE_GENERIC_ITEM_INFO_VAR_NAME].value
-            raise errors.Request.Failed(f"URL: {url}, STATUS: {response.status}")
+        with profiler.span("fetch"):
+            async with session.get(url) as response:
+                if response.status != 200:
+                    raise errors.Request.Failed(f"URL: {url}, STATUS: {response.status}")
+                html = await response.text()
+        with profiler.span("parse"):
+            extracted_vars = helpers.JSVariableExtractor(html).extract()
+            return extracted_vars[item_types.BASE_GENERIC_ITEM_INFO_VAR_NAME].value
 
     def new_owners(self, bc_copies: item_types.BCCopiesData, check_after_time: int) -> item_types.NewItemOwners:
         items = []
@@ -113,67 +155,176 @@ class Monitor:
         return received_items
 
     async def process_items_batch(self, item_ids: List[str]) -> None:
-        for item_id in item_ids:
+        with profiler.span("batch", size=len(item_ids)):
+            for item_id in item_ids:
+                try:
+                    with profiler.span("item", item_id=item_id):
+                        await self.process_item(item_id)
+                except Exception as e:
+                    print(f"Error processing item {item_id}: {e}")
+                finally:
+                    self.pending_items.discard(item_id)
+
+        if self.shard:
             try:
-                item_info = await self.get_limited_item_info(item_id)
-                assert not isinstance(item_info, errors.Request.Failed)
-
-                for uaid, owner_id, time_occured in self.new_owners(item_info, self.check_after_time):
-                    old_owners = await self.get_uaid_past_owners(uaid)
-                    try:
-                        current_index = old_owners.index(str(owner_id))
-                    except ValueError:
-                        current_index = None
-
-                    old_index = current_index + 1 if current_index is not None else 0
-                    if old_index >= len(old_owners):
-                        continue
-
-                    old_owner_id = old_owners[old_index]
-                    if old_owner_id == str(owner_id):
-                        continue
-
-                    possible_received = await self.possible_items_received(owner_id, time_occured)
-                    possible_sent = await self.possible_items_received(old_owner_id, time_occured)
-
-                    if not (possible_received and possible_sent):
-                        continue
-
-                    items_received = await self.deep_check_items_received(possible_received, owner_id, old_owner_id)
-                    items_sent = await self.deep_check_items_received(possible_sent, old_owner_id, owner_id)
+                await self.db.save_item_watermarks({item_id: self.item_watermarks[item_id] for item_id in item_ids if item_id in self.item_watermarks})
+            except Exception as e:
+                print(f"Error sharing item watermarks: {e}")
 
-                    if items_received and items_sent:
-                        trade_id = str(uuid.uuid4())
-                        timestamp = int(datetime.now(timezone.utc).timestamp() * 1000)
-                        
-                        await self.db.insert_trade(trade_id, str(owner_id), str(old_owner_id), timestamp)
+        if self.last_iteration_time:
+            self.check_after_time = max(self.last_iteration_time)
 
-                        for item_id, uaid in items_received:
-                            await self.db.insert_trade_item(trade_id, str(owner_id), item_id, uaid, True)
+    async def process_item(self, item_id: str) -> None:
+        item_info = await self.get_limited_item_info(item_id)
+        assert not isinstance(item_info, errors.Request.Failed)
+
+        # check_after_time follows whatever items this worker has seen, an item just handed over from another worker could be behind it
+        floor = self.watermark_floor if self.shard else self.check_after_time
+        check_after_time = max(floor, self.item_watermarks.get(item_id, 0))
+        for uaid, owner_id, time_occured in self.new_owners(item_info, check_after_time):
+            with profiler.span("ownership_check", uaid=uaid):
+                old_owners = await self.get_uaid_past_owners(uaid)
+                try:
+                    current_index = old_owners.index(str(owner_id))
+                except ValueError:
+                    current_index = None
+
+            old_index = current_index + 1 if current_index is not None else 0
+            if old_index >= len(old_owners):
+                continue
 
-                        for item_id, uaid in items_sent:
-                            await self.db.insert_trade_item(trade_id, str(old_owner_id), item_id, uaid, False)
+            old_owner_id = old_owners[old_index]
+            if old_owner_id == str(owner_id):
+                continue
 
+            self.correlation.add(correlation.OwnershipChange(uaid, int(item_id), old_owner_id, str(owner_id), time_occured))
+
+        if item_info["bc_updated"]:
+            self.item_watermarks[item_id] = max(item_info["bc_updated"])
+
+    async def check_trade_fallback(self, change: correlation.OwnershipChange) -> None:
+        # no reciprocal transfer showed up in the sweep, so scan both inventories to find the other side
+        owner_id, old_owner_id, time_occured = change.receiver_id, change.sender_id, change.time
+
+        with profiler.span("inventory"):
+            possible_received = await self.possible_items_received(owner_id, time_occured)
+            possible_sent = await self.possible_items_received(old_owner_id, time_occured)
+
+        if not (possible_received and possible_sent):
+            return
+
+        with profiler.span("deep_check"):
+            items_received = await self.deep_check_items_received(possible_received, owner_id, old_owner_id)
+            items_sent = await self.deep_check_items_received(possible_sent, old_owner_id, owner_id)
+
+        if items_received and items_sent:
+            await self.persist_trade(owner_id, old_owner_id, items_received, items_sent)
+
+    async def persist_trade(self, owner_id: str, old_owner_id: str, items_received: item_types.ItemsReceived, items_sent: item_types.ItemsReceived) -> None:
+        # both the correlated and the fallback path key the trade off the uaid histories, so they agree on the id
+        hops = {}
+        with profiler.span("ownership_hops"):
+            for receiver_id, items in ((owner_id, items_received), (old_owner_id, items_sent)):
+                for _, uaid in items:
+                    hops[uaid] = state.transfer_hop(await self.get_uaid_past_owners(uaid), receiver_id)
+        trade_id = state.trade_key(owner_id, old_owner_id, items_received, items_sent, hops)
+        timestamp = int(datetime.now(timezone.utc).timestamp() * 1000)
+        trade_items = [(owner_id, received_item_id, received_uaid, True) for received_item_id, received_uaid in items_received] + \
+                      [(old_owner_id, sent_item_id, sent_uaid, False) for sent_item_id, sent_uaid in items_sent]
+
+        with profiler.span("persist"):
+            await self.db.insert_trade_with_items(trade_id, owner_id, old_owner_id, timestamp, trade_items)
+
+    async def process_fallback_batch(self, changes: List[correlation.OwnershipChange]) -> None:
+        with profiler.span("fallback_batch", size=len(changes)):
+            for change in changes:
+                try:
+                    await self.check_trade_fallback(change)
+                except Exception as e:
+                    print(f"Error checking uaid {change.uaid}: {e}")
+
+    async def share_changes(self) -> None:
+        # with the catalog split over workers the two halves of a trade are usually seen by different workers,
+        # so each one publishes what it saw and pulls in the changes other workers saw between the same users
+        local = [change for change in self.correlation.pending() if change.local]
+        if local:
+            await self.db.publish_ownership_changes([
+                (change.uaid, change.item_id, change.sender_id, change.receiver_id, change.time, correlation.pair_key(change))
+                for change in local
+            ])
+            since = min(change.time for change in local) - self.correlation.window
+            for row in await self.db.fetch_ownership_changes({correlation.pair_key(change) for change in local}, since):
+                self.correlation.add(correlation.OwnershipChange(*row, local=False))
+        if self.shard and self.shard.owns("ownership_changes"):
+            now = int(datetime.now(timezone.utc).timestamp() * 1000)
+            await self.db.delete_ownership_changes(now - 2 * self.correlation.window)
+
+    async def resolve_changes(self) -> None:
+        if self.shard:
+            try:
+                with profiler.span("share_changes"):
+                    await self.share_changes()
+            except Exception as e:
+                print(f"Error sharing ownership changes: {e}")
+        now = int(datetime.now(timezone.utc).timestamp() * 1000)
+        with profiler.span("correlate"):
+            trades = self.correlation.match(now)
+        for trade in trades:
+            if not trade.local:
+                # made up only of other workers' changes, the worker that saw them stores it
+                continue
+            try:
+                await self.persist_trade(trade.receiver_id, trade.sender_id, trade.items_received, trade.items_sent)
             except Exception as e:
-                print(f"Error processing item {item_id}: {e}")
+                print(f"Error saving trade between {trade.receiver_id} and {trade.sender_id}: {e}")
 
-        if self.last_iteration_time:
-            self.check_after_time = max(self.last_iteration_time)
+        expired = self.correlation.expire(now - self.correlation.window)
+        if expired:
+            chunk_size = max(1, len(expired) // 10)
+            await asyncio.gather(*[
+                asyncio.create_task(self.process_fallback_batch(expired[i:i + chunk_size]))
+                for i in range(0, len(expired), chunk_size)
+            ])
 
     async def __call__(self):
+        background = []
+        if self.state_path:
+            background.append(asyncio.create_task(self._checkpoint_loop()))
+        if self.shard:
+            await self.shard.refresh()
+            background.append(asyncio.create_task(self.shard.heartbeat_loop()))
+        try:
+            await self._run()
+        finally:
+            for task in background:
+                task.cancel()
+            self.checkpoint()
+            if self.shard:
+                await self.shard.release()
+
+    async def _run(self):
         while True:
             try:
-                items = await self.get_limited_ids()
-                assert not isinstance(items, errors.Request.Failed)
-                item_ids = list(items)
-                chunk_size = max(1, len(item_ids) // 10)
-                tasks = []
-
-                for i in range(0, len(item_ids), chunk_size):
-                    chunk = item_ids[i:i + chunk_size]
-                    tasks.append(asyncio.create_task(self.process_items_batch(chunk)))
-
-                await asyncio.gather(*tasks)
+                with self.profiler.cycle() if self.profiler else nullcontext():
+                    with profiler.span("catalog"):
+                        items = await self.get_limited_ids()
+                    assert not isinstance(items, errors.Request.Failed)
+                    item_ids = list(items)
+                    if self.shard:
+                        item_ids = [item_id for item_id in item_ids if self.shard.owns(item_id)]
+                        await self.load_shared_watermarks()
+                    # whatever was left unfinished by the last cycle (or the last process) goes first
+                    item_ids.sort(key=lambda item_id: item_id not in self.pending_items)
+                    self.pending_items = set(item_ids)
+                    chunk_size = max(1, len(item_ids) // 10)
+                    tasks = []
+
+                    for i in range(0, len(item_ids), chunk_size):
+                        chunk = item_ids[i:i + chunk_size]
+                        tasks.append(asyncio.create_task(self.process_items_batch(chunk)))
+
+                    await asyncio.gather(*tasks)
+                    await self.resolve_changes()
 
             except Exception as e:
                 print(f"Main loop error: {e}")
@@ -0,0 +1,86 @@
+from trademonitor.data_types import item_types
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+@dataclass(frozen=True)
+class OwnershipChange:
+    uaid: int
+    item_id: int
+    sender_id: str
+    receiver_id: str
+    time: int
+    # False for changes another worker saw, those only help match and are never persisted or scanned here
+    local: bool = field(default=True, compare=False)
+
+def pair_key(change: OwnershipChange) -> str:
+    return ":".join(sorted((change.sender_id, change.receiver_id)))
+
+@dataclass
+class CorrelatedTrade:
+    receiver_id: str
+    sender_id: str
+    items_received: item_types.ItemsReceived
+    items_sent: item_types.ItemsReceived
+    local: bool = True
+
+class CorrelationIndex:
+    def __init__(self, window: int = 600000):
+        self.window = window
+        self._by_pair: Dict[Tuple[str, str], List[OwnershipChange]] = {}
+
+    @staticmethod
+    def _pair(change: OwnershipChange) -> Tuple[str, str]:
+        return tuple(sorted((change.sender_id, change.receiver_id)))  # type: ignore
+
+    def add(self, change: OwnershipChange) -> None:
+        changes = self._by_pair.setdefault(self._pair(change), [])
+        if change not in changes:
+            changes.append(change)
+
+    def pending(self) -> List[OwnershipChange]:
+        return [change for changes in self._by_pair.values() for change in changes]
+
+    def match(self, now: int) -> List[CorrelatedTrade]:
+        # a trade shows up as transfers in both directions between the same two users within the window,
+        # a cluster is only emitted once its window has closed, a trade caught mid-sweep still has changes to come
+        trades = []
+        for pair in list(self._by_pair):
+            changes = sorted(self._by_pair[pair], key=lambda change: change.time)
+            remaining = []
+            while changes:
+                anchor = changes[0]
+                if anchor.time + self.window >= now:
+                    remaining.extend(changes)
+                    break
+                cluster = [change for change in changes if change.time - anchor.time <= self.window]
+                received = [change for change in cluster if change.receiver_id == anchor.receiver_id]
+                sent = [change for change in cluster if change.receiver_id != anchor.receiver_id]
+                if received and sent:
+                    trades.append(CorrelatedTrade(
+                        anchor.receiver_id,
+                        anchor.sender_id,
+                        [(change.item_id, change.uaid) for change in received],
+                        [(change.item_id, change.uaid) for change in sent],
+                        any(change.local for change in cluster),
+                    ))
+                    changes = [change for change in changes if change not in cluster]
+                else:
+                    remaining.append(anchor)
+                    changes = changes[1:]
+            if remaining:
+                self._by_pair[pair] = remaining
+            else:
+                del self._by_pair[pair]
+        return trades
+
+    def expire(self, before: int) -> List[OwnershipChange]:
+        # unmatched changes too old to still meet their other half, handed back for the slow path
+        expired = []
+        for pair in list(self._by_pair):
+            keep = [change for change in self._by_pair[pair] if change.time >= before]
+            expired.extend(change for change in self._by_pair[pair] if change.time < before and change.local)
+            if keep:
+                self._by_pair[pair] = keep
+            else:
+                del self._by_pair[pair]
+        return expired
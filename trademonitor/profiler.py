@@ -0,0 +1,105 @@
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+import os
+import json
+import time
+
+@dataclass
+class Span:
+    name: str
+    start: int
+    end: int = 0
+    attrs: Dict[str, Any] = field(default_factory=dict)
+    children: List["Span"] = field(default_factory=list)
+
+    @property
+    def duration(self) -> int:
+        return self.end - self.start
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("trademonitor_current_span", default=None)
+
+def _now_us() -> int:
+    return time.perf_counter_ns() // 1000
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Optional[Span]]:
+    # no-op unless a profiled cycle is active in this task's context
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    node = Span(name, _now_us(), attrs=attrs)
+    parent.children.append(node)
+    token = _current_span.set(node)
+    try:
+        yield node
+    finally:
+        node.end = _now_us()
+        _current_span.reset(token)
+
+class Profiler:
+    def __init__(self, max_cycles: int = 20):
+        self.cycles: Deque[Span] = deque(maxlen=max_cycles)
+        self._cycle_count = 0
+
+    @contextmanager
+    def cycle(self) -> Iterator[Span]:
+        self._cycle_count += 1
+        root = Span("cycle", _now_us(), attrs={"cycle": self._cycle_count})
+        token = _current_span.set(root)
+        try:
+            yield root
+        finally:
+            root.end = _now_us()
+            _current_span.reset(token)
+            self.cycles.append(root)
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        # concurrent batches overlap in time, so every top-level child of a cycle gets its own track
+        events: List[Dict[str, Any]] = []
+        pid = os.getpid()
+
+        def emit(node: Span, tid: int) -> None:
+            events.append({
+                "name": node.name,
+                "ph": "X",
+                "ts": node.start,
+                "dur": node.duration,
+                "pid": pid,
+                "tid": tid,
+                "args": node.attrs,
+            })
+            for child in node.children:
+                emit(child, tid)
+
+        for root in list(self.cycles):
+            emit(Span(root.name, root.start, root.end, root.attrs), 0)
+            for tid, child in enumerate(root.children, start=1):
+                emit(child, tid)
+
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def collapsed_stacks(self) -> str:
+        # self time per stack in microseconds, as consumed by flamegraph.pl / speedscope
+        totals: Dict[str, int] = {}
+
+        def walk(node: Span, prefix: str) -> None:
+            stack = f"{prefix};{node.name}" if prefix else node.name
+            self_time = node.duration - sum(child.duration for child in node.children)
+            totals[stack] = totals.get(stack, 0) + max(0, self_time)
+            for child in node.children:
+                walk(child, stack)
+
+        for root in list(self.cycles):
+            walk(root, "")
+
+        return "\n".join(f"{stack} {value}" for stack, value in totals.items() if value > 0)
+
+    def dump(self, path: str) -> str:
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+        return path
@@ -0,0 +1,64 @@
+from helpers import DBHelper
+from typing import Dict, List, Optional
+
+import bisect
+import asyncio
+import hashlib
+
+def _hash(key: str) -> int:
+    # md5 rather than hash() so every process and host agrees on the ring
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+class HashRing:
+    def __init__(self, nodes: List[str], replicas: int = 64):
+        self.nodes = sorted(nodes)
+        self._points: List[int] = []
+        self._owners: Dict[int, str] = {}
+        for node in self.nodes:
+            for replica in range(replicas):
+                point = _hash(f"{node}#{replica}")
+                self._owners[point] = node
+                bisect.insort(self._points, point)
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+class ShardCoordinator:
+    def __init__(self, db: DBHelper, worker_id: str, lease_ttl: int = 60, replicas: int = 64):
+        self.db = db
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self.replicas = replicas
+        self.ring = HashRing([worker_id], replicas)
+
+    async def refresh(self) -> None:
+        try:
+            await self.db.heartbeat_worker(self.worker_id)
+            workers = await self.db.fetch_live_workers(self.lease_ttl * 1000)
+        except Exception as e:
+            # keep the last known ring, a short db outage shouldn't reshuffle the whole catalog
+            print(f"Shard lease refresh failed: {e}")
+            return
+        if self.worker_id not in workers:
+            workers.append(self.worker_id)
+        if sorted(workers) != self.ring.nodes:
+            print(f"Shard ring changed: {sorted(workers)}")
+            self.ring = HashRing(workers, self.replicas)
+
+    def owns(self, item_id: str) -> bool:
+        return self.ring.owner(str(item_id)) == self.worker_id
+
+    async def heartbeat_loop(self) -> None:
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.lease_ttl / 3)
+
+    async def release(self) -> None:
+        # drop the lease right away so the other workers pick up our items without waiting out the ttl
+        try:
+            await self.db.remove_worker(self.worker_id)
+        except Exception as e:
+            print(f"Shard lease release failed: {e}")
@@ -0,0 +1,51 @@
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional
+
+import os
+import gzip
+import json
+import hashlib
+
+@dataclass
+class MonitorState:
+    check_after_time: int
+    item_watermarks: Dict[str, int] = field(default_factory=dict)
+    pending_items: List[str] = field(default_factory=list)
+    pending_changes: List[list] = field(default_factory=list)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["MonitorState"]:
+        try:
+            with gzip.open(path, "rt") as f:
+                data = json.load(f)
+            return cls(**data)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Ignoring unreadable monitor checkpoint {path}: {e}")
+            return None
+
+    def save(self, path: str) -> None:
+        # write then rename so a crash mid-write never leaves a truncated checkpoint behind
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, "wt") as f:
+            json.dump(asdict(self), f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+def transfer_hop(past_owners: List[str], receiver_id: str) -> int:
+    # where the transfer sits in the uaid's ownership chain counted from the first owner (past owners are
+    # newest first), later owners don't move it and it doesn't depend on when or how the trade was found
+    try:
+        return len(past_owners) - past_owners.index(receiver_id)
+    except ValueError:
+        # the history hasn't caught up yet, the receiver is about to become the newest owner
+        return len(past_owners) + 1
+
+def trade_key(user_one_id: str, user_two_id: str, items_received: List, items_sent: List, hops: Dict[int, int]) -> str:
+    # the same trade seen from either side (or on a later cycle) hashes to the same id, the hops keep a
+    # later trade moving the same uaids between the same users from colliding with it
+    transfers = sorted(
+        [f"{user_one_id}:{uaid}:{hops[uaid]}" for _, uaid in items_received] +
+        [f"{user_two_id}:{uaid}:{hops[uaid]}" for _, uaid in items_sent]
+    )
+    return hashlib.sha256("|".join(transfers).encode()).hexdigest()[:32]